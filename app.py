@@ -2,24 +2,22 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import time
-import random
 from datetime import datetime
-import json
-import plotly.graph_objects as go
-import plotly.express as px
-from experiment import ExperimentManager
+from typing import Callable, NamedTuple
 from data_manager import DataManager
-from mtf_experiment import MTFExperimentManager
+from mtf_experiment import MTFExperimentManager, encode_png_data_url
 from csv_data_manager import CSVDataManager
 import cv2
 from PIL import Image
 import base64
+import struct
 from io import BytesIO
 import os
 
 # 環境檢測：根據不同環境設定不同端口
+@st.cache_resource(show_spinner=False)
 def detect_environment():
-    """檢測當前運行環境並設定相應的端口"""
+    """檢測當前運行環境並設定相應的端口（每個進程只執行一次，重新執行腳本時不再重複檢測）"""
     import platform
     
     # 檢查是否在 Replit 環境
@@ -78,6 +76,29 @@ def crop_image_to_viewport(image_array, target_width=800, target_height=600):
     resized = cv2.resize(cropped, (target_width, target_height))
     return resized
 
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _data_url_image_size(data_url):
+    """Return (width, height) of a base64 image data URL without decoding its pixels"""
+    base64_data = data_url.split(',', 1)[1]
+    # PNG: signature (8 bytes), IHDR length + type (8 bytes), then big-endian width and height.
+    # The first 32 base64 characters decode to exactly those 24 bytes
+    header = base64.b64decode(base64_data[:32])
+    if header[:8] == _PNG_SIGNATURE and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+    # Other formats: Image.open is lazy and only parses the header
+    with Image.open(BytesIO(base64.b64decode(base64_data))) as img:
+        return img.size
+
+# Stimulus markup for display_mtf_stimulus_image; only the id, image source and caption vary
+_MTF_STIMULUS_HTML = """
+    <div style="text-align: center; margin: 20px 0;">
+        <img id="{img_id}" src="{src}" 
+             style="max-width: 100%; height: auto;">
+        <p style="margin: 10px 0; color: #666; font-size: 14px;">{caption}</p>
+    </div>
+    """
+
 def display_mtf_stimulus_image(image_data, caption=""):
     """
     Display MTF stimulus image for the experiment
@@ -90,50 +111,37 @@ def display_mtf_stimulus_image(image_data, caption=""):
     # Process image data format
     if isinstance(image_data, str):
         if image_data.startswith('data:image'):
-            # Extract base64 data
-            base64_data = image_data.split(',')[1]
-            img_bytes = base64.b64decode(base64_data)
-            img = Image.open(BytesIO(img_bytes))
-            image_array = np.array(img)
+            # Already encoded: embed the data URL as-is instead of decoding and re-encoding it
+            final_w, final_h = _data_url_image_size(image_data)
+            src = image_data
         else:
             st.error("❌ Invalid image data format")
             return None
-    elif isinstance(image_data, np.ndarray):
-        image_array = image_data
     else:
-        try:
-            image_array = np.array(image_data)
-        except Exception as e:
-            st.error(f"❌ Failed to convert to numpy array: {e}")
+        if isinstance(image_data, np.ndarray):
+            image_array = image_data
+        else:
+            try:
+                image_array = np.array(image_data)
+            except Exception as e:
+                st.error(f"❌ Failed to convert to numpy array: {e}")
+                return None
+        
+        if not isinstance(image_array, np.ndarray):
+            st.error("❌ Invalid image array")
             return None
-    
-    if not isinstance(image_array, np.ndarray):
-        st.error("❌ Invalid image array")
-        return None
-    
-    # Process the image for display
-    processed_img = image_array
-    
-    # Convert to PIL for display
-    img_pil = Image.fromarray(processed_img)
-    
-    # Convert to base64 for HTML display
-    buffer = BytesIO()
-    img_pil.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
+        
+        # Bind the dimensions once; they are reused for the returned layout info
+        final_h, final_w = image_array.shape[:2]
+        src = encode_png_data_url(image_array)
     
     # Add unique ID for positioning calculation
     img_id = f"mtf_img_{int(time.time() * 1000)}"
-    final_h, final_w = processed_img.shape[:2]
     
     # Clean HTML for stimulus display
-    html_content = f"""
-    <div style="text-align: center; margin: 20px 0;">
-        <img id="{img_id}" src="data:image/png;base64,{img_str}" 
-             style="max-width: 100%; height: auto;">
-        <p style="margin: 10px 0; color: #666; font-size: 14px;">{caption}</p>
-    </div>
-    """
+    html_content = _MTF_STIMULUS_HTML.format(
+        img_id=img_id, src=src, caption=caption
+    )
     st.markdown(html_content, unsafe_allow_html=True)
     
     # Return image dimensions for button positioning
@@ -151,6 +159,23 @@ def display_fullscreen_image(image_data, caption=""):
     """
     return display_mtf_stimulus_image(image_data, caption)
 
+class AdoPrecisionLevel(NamedTuple):
+    """ADO precision level, for threshold SDs below `bound` (see _ADO_PRECISION_LEVELS)"""
+    bound: float
+    kind: Callable        # st.success / st.warning / st.info, used for the monitor label
+    monitor_label: str    # sidebar ADO monitor
+    caption: str          # feedback after each response
+
+_ADO_PRECISION_LEVELS = (
+    AdoPrecisionLevel(5, st.success, "✅ 高精度", "🎯 High precision"),
+    AdoPrecisionLevel(10, st.warning, "⚡ 中等精度", "📈 Converging"),
+    AdoPrecisionLevel(float('inf'), st.info, "🔄 學習中", "🔄 Learning")
+)
+
+def _ado_precision_level(threshold_sd):
+    """Look up the precision level for a threshold SD (NaN falls through to the last level)"""
+    return next((level for level in _ADO_PRECISION_LEVELS if threshold_sd < level.bound), _ADO_PRECISION_LEVELS[-1])
+
 def display_ado_monitor(exp_manager, trial_number):
     """
     Display ADO monitoring information in a sidebar or expander
@@ -183,21 +208,19 @@ def display_ado_monitor(exp_manager, trial_number):
             st.markdown(f"**試驗次數:** {trial_number}")
             
             # Convergence status
-            if uncertainty < 5:
-                st.success("✅ 高精度")
-            elif uncertainty < 10:
-                st.warning("⚡ 中等精度")
-            else:
-                st.info("🔄 學習中")
+            level = _ado_precision_level(uncertainty)
+            level.kind(level.monitor_label)
                 
             # Show detailed trial history
             if hasattr(exp_manager, 'trial_data') and len(exp_manager.trial_data) > 0:
                 st.markdown("**試驗歷史:**")
                 recent_trials = exp_manager.trial_data[-5:]  # Last 5 trials
-                for trial in recent_trials:
-                    response_text = "✓ 清晰" if trial.get('response', False) else "✗ 不清晰"
-                    rt = trial.get('reaction_time', 0)
-                    st.text(f"T{trial.get('trial_number', 0)}: {trial.get('mtf_value', 0):.1f}% → {response_text} ({rt:.1f}s)")
+                # One text element for all lines instead of one per trial
+                st.text("\n".join(
+                    f"T{trial.get('trial_number', 0)}: {trial.get('mtf_value', 0):.1f}% → "
+                    f"{'✓ 清晰' if trial.get('response', False) else '✗ 不清晰'} ({trial.get('reaction_time', 0):.1f}s)"
+                    for trial in recent_trials
+                ))
             
             # ADO optimization details
             st.markdown("**優化詳情:**")
@@ -244,6 +267,9 @@ def plot_psychometric_function(trial_data):
         st.warning("Not enough data points for psychometric function")
         return
     
+    # Imported here: plotly is slow to import and only needed once results are shown
+    import plotly.graph_objects as go
+    
     # Create the plot
     fig = go.Figure()
     
@@ -343,6 +369,22 @@ if 'current_trial_data' not in st.session_state:
 if 'trial_locked' not in st.session_state:
     st.session_state.trial_locked = False
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def _load_preview_thumbnail(img_path: str, mtime_ns: int, max_size: int):
+    """Load a stimulus preview scaled to fit max_size (cached per file version via mtime_ns)
+    Returns: (thumbnail image, original (width, height))
+    """
+    with Image.open(img_path) as img:
+        # Calculate scaling factor to fit within max_size while preserving aspect ratio
+        original_width, original_height = img.size
+        scale_factor = min(max_size / original_width, max_size / original_height)
+        new_width = int(original_width * scale_factor)
+        new_height = int(original_height * scale_factor)
+        
+        # Resize image maintaining aspect ratio
+        img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    return img_resized, (original_width, original_height)
+
 def welcome_screen():
     """Display welcome screen and collect participant information"""
     st.title("🧠 MTF Clarity Testing Experiment")
@@ -400,20 +442,10 @@ def welcome_screen():
             with cols[i]:
                 # Display thumbnail with proper aspect ratio preservation
                 try:
-                    from PIL import Image
-                    img = Image.open(img_path)
-                    
-                    # Calculate proper thumbnail size maintaining aspect ratio
-                    original_width, original_height = img.size
-                    max_size = 200
-                    
-                    # Calculate scaling factor to fit within max_size while preserving aspect ratio
-                    scale_factor = min(max_size / original_width, max_size / original_height)
-                    new_width = int(original_width * scale_factor)
-                    new_height = int(original_height * scale_factor)
-                    
-                    # Resize image maintaining aspect ratio
-                    img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                    img_resized, (original_width, original_height) = _load_preview_thumbnail(
+                        img_path, os.stat(img_path).st_mtime_ns, 200
+                    )
+                    new_width = img_resized.width
                     
                     # Display with fixed width to ensure consistent layout
                     # Create descriptive captions
@@ -425,7 +457,8 @@ def welcome_screen():
                     }
                     display_name = caption_map.get(img_name, img_name.replace('.png', ''))
                     
-                    st.image(img_resized, caption=display_name, width=new_width)
+                    # Previews only, so lossy JPEG is fine and much smaller than PNG
+                    st.image(img_resized, caption=display_name, width=new_width, output_format='JPEG')
                     st.caption(f"Size: {original_width}×{original_height}")
                     
                     # Selection button
@@ -600,10 +633,12 @@ def instructions_screen():
         with col1:
             st.subheader("Your Stimulus:")
             try:
-                from PIL import Image
-                img = Image.open(st.session_state.selected_stimulus_image)
-                img.thumbnail((150, 150))
-                st.image(img, caption=os.path.basename(st.session_state.selected_stimulus_image).replace('.png', ''))
+                img, _ = _load_preview_thumbnail(
+                    st.session_state.selected_stimulus_image,
+                    os.stat(st.session_state.selected_stimulus_image).st_mtime_ns, 150
+                )
+                st.image(img, caption=os.path.basename(st.session_state.selected_stimulus_image).replace('.png', ''),
+                         output_format='JPEG')
             except Exception:
                 st.text("Preview not available")
         with col2:
@@ -668,6 +703,25 @@ def instructions_screen():
 
 # 2AFC functions removed - this app now focuses exclusively on MTF clarity testing
 
+# Stimulus patch for run_trial; only the gray level, intensity and label change per trial
+_BRIGHTNESS_STIMULUS_HTML = """
+            <div style="
+                width: 150px; 
+                height: 150px; 
+                border-radius: 50%; 
+                background-color: rgb({gray}, {gray}, {gray}); 
+                margin: 20px auto;
+                border: 3px solid #333;
+                box-shadow: 0 0 10px rgba(0,0,0,0.3);
+            "></div>
+            <p style="text-align: center; font-size: 12px; color: #666;">
+                Brightness: {intensity:.3f}
+            </p>
+            <p style="text-align: center; font-size: 10px; color: #999;">
+                {label}
+            </p>
+            """
+
 def run_trial(is_practice=False):
     """Run a single trial"""
     exp_manager = st.session_state.experiment_manager
@@ -723,48 +777,22 @@ def run_trial(is_practice=False):
             st.markdown("### Left Stimulus")
             # Display stimulus with better contrast visibility
             left_intensity = current_trial['left_stimulus']
-            # Convert to grayscale value (0=black, 255=white)
-            gray_value = int(left_intensity * 255)
-            st.markdown(f"""
-            <div style="
-                width: 150px; 
-                height: 150px; 
-                border-radius: 50%; 
-                background-color: rgb({gray_value}, {gray_value}, {gray_value}); 
-                margin: 20px auto;
-                border: 3px solid #333;
-                box-shadow: 0 0 10px rgba(0,0,0,0.3);
-            "></div>
-            <p style="text-align: center; font-size: 12px; color: #666;">
-                Brightness: {left_intensity:.3f}
-            </p>
-            <p style="text-align: center; font-size: 10px; color: #999;">
-                {'BRIGHTER' if left_intensity > current_trial['right_stimulus'] else 'dimmer'}
-            </p>
-            """, unsafe_allow_html=True)
+            st.markdown(_BRIGHTNESS_STIMULUS_HTML.format(
+                # Convert to grayscale value (0=black, 255=white)
+                gray=int(left_intensity * 255),
+                intensity=left_intensity,
+                label='BRIGHTER' if left_intensity > current_trial['right_stimulus'] else 'dimmer'
+            ), unsafe_allow_html=True)
         
         with stim_col2:
             st.markdown("### Right Stimulus")
             right_intensity = current_trial['right_stimulus']
-            # Convert to grayscale value (0=black, 255=white)
-            gray_value = int(right_intensity * 255)
-            st.markdown(f"""
-            <div style="
-                width: 150px; 
-                height: 150px; 
-                border-radius: 50%; 
-                background-color: rgb({gray_value}, {gray_value}, {gray_value}); 
-                margin: 20px auto;
-                border: 3px solid #333;
-                box-shadow: 0 0 10px rgba(0,0,0,0.3);
-            "></div>
-            <p style="text-align: center; font-size: 12px; color: #666;">
-                Brightness: {right_intensity:.3f}
-            </p>
-            <p style="text-align: center; font-size: 10px; color: #999;">
-                {'BRIGHTER' if right_intensity > current_trial['left_stimulus'] else 'dimmer'}
-            </p>
-            """, unsafe_allow_html=True)
+            st.markdown(_BRIGHTNESS_STIMULUS_HTML.format(
+                # Convert to grayscale value (0=black, 255=white)
+                gray=int(right_intensity * 255),
+                intensity=right_intensity,
+                label='BRIGHTER' if right_intensity > current_trial['left_stimulus'] else 'dimmer'
+            ), unsafe_allow_html=True)
     
     # Record trial start time if not already recorded
     if not st.session_state.awaiting_response:
@@ -937,6 +965,19 @@ def show_animated_fixation(elapsed: float):
     </div>
     """, unsafe_allow_html=True)
 
+# Opening tag of the response button column; only the top padding (vh) changes per trial
+_RESPONSE_PANEL_OPEN_HTML = """
+                <div style="
+                    display: flex;
+                    flex-direction: column;
+                    justify-content: flex-start;
+                    align-items: center;
+                    padding-top: %svh;
+                    min-height: 70vh;
+                    gap: 20px;
+                ">
+                """
+
 def mtf_trial_screen():
     """Handle MTF clarity testing trials with proper timing sequence"""
     # Debug session state
@@ -1103,17 +1144,7 @@ def mtf_trial_screen():
                     # Fallback positioning
                     padding_top = 30
                 
-                st.markdown(f"""
-                <div style="
-                    display: flex;
-                    flex-direction: column;
-                    justify-content: flex-start;
-                    align-items: center;
-                    padding-top: {padding_top}vh;
-                    min-height: 70vh;
-                    gap: 20px;
-                ">
-                """, unsafe_allow_html=True)
+                st.markdown(_RESPONSE_PANEL_OPEN_HTML % padding_top, unsafe_allow_html=True)
                 
                 st.markdown("### Is this image clear?")
                 
@@ -1323,13 +1354,7 @@ def record_mtf_response_smooth(trial_data, is_clear):
         
         with col2:
             st.metric("Threshold Est.", f"{new_estimates.get('threshold_mean', 0):.1f}%")
-            current_sd = new_estimates.get('threshold_sd', 0)
-            if current_sd < 5:
-                st.caption("🎯 High precision")
-            elif current_sd < 10:
-                st.caption("📈 Converging")
-            else:
-                st.caption("🔄 Learning")
+            st.caption(_ado_precision_level(new_estimates.get('threshold_sd', 0)).caption)
         
         with col3:
             # Show next MTF preview
@@ -1469,6 +1494,11 @@ def mtf_results_screen():
     summary = exp_manager.get_experiment_summary()
     trial_data = exp_manager.export_data()
     
+    # The run is over: close the participant's CSV file and mark the record completed (once per run)
+    if 'csv_manager' in st.session_state and not st.session_state.get('mtf_data_completed'):
+        st.session_state.csv_manager.complete_experiment(st.session_state.get('participant_id') or 'unknown')
+        st.session_state.mtf_data_completed = True
+    
     st.title("🎉 MTF Experiment Complete!")
     st.balloons()
     
@@ -1545,40 +1575,67 @@ def mtf_results_screen():
         st.session_state.experiment_stage = 'welcome'
         st.rerun()
 
-def plot_mtf_psychometric_function(trial_data):
-    """Plot psychometric function for MTF data"""
-    if not trial_data:
-        st.warning("No trial data available for plotting")
-        return
-    
-    df = pd.DataFrame(trial_data)
-    
-    # Group by MTF value and calculate proportion clear
-    grouped = df.groupby('mtf_value').agg({
-        'response': ['count', 'sum', 'mean'],
-        'reaction_time': 'mean'
-    }).round(3)
-    
-    grouped.columns = ['n_trials', 'n_clear', 'prop_clear', 'mean_rt']
-    grouped = grouped.reset_index()
-    
-    # Filter groups with sufficient data
-    grouped = grouped[grouped['n_trials'] >= 1]
-    
-    if len(grouped) == 0:
-        st.warning("Not enough data points for psychometric function")
-        return
+class GroupedData(NamedTuple):
+    """Per-MTF-level trial summary, one array per column (ascending MTF order)"""
+    mtf_value: np.ndarray
+    n_trials: np.ndarray
+    n_clear: np.ndarray
+    prop_clear: np.ndarray
+    mean_rt: np.ndarray
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _group_mtf_trials(mtf_values: np.ndarray, responses: np.ndarray, reaction_times: np.ndarray) -> dict:
+    """Group MTF trials by MTF value (cached, so reruns with unchanged data skip the grouping)"""
+    mtf_values = np.asarray(mtf_values, dtype=np.float64)
+    responses = np.asarray(responses, dtype=np.float64)
+    reaction_times = np.asarray(reaction_times, dtype=np.float64)
+    
+    # Same semantics as groupby: rows without an MTF value are dropped, missing values skipped.
+    # factorize hashes instead of sorting every trial; sort=True keeps ascending MTF levels
+    codes, levels = pd.factorize(mtf_values, sort=True)
+    keep = codes >= 0
+    codes = codes[keep]
+    responses = responses[keep]
+    reaction_times = reaction_times[keep]
+    
+    # Per-level sums and counts in one bincount pass each
+    has_response = ~np.isnan(responses)
+    has_rt = ~np.isnan(reaction_times)
+    n_trials = np.bincount(codes, weights=has_response, minlength=len(levels))
+    n_clear = np.bincount(codes, weights=np.where(has_response, responses, 0.0), minlength=len(levels))
+    rt_sum = np.bincount(codes, weights=np.where(has_rt, reaction_times, 0.0), minlength=len(levels))
+    rt_count = np.bincount(codes, weights=has_rt, minlength=len(levels))
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prop_clear = n_clear / n_trials
+        mean_rt = rt_sum / rt_count
+    
+    # Narrow dtypes: the extra precision is meaningless here and halves the Plotly payload
+    # (a plain dict so st.cache_data can pickle it; callers wrap it in GroupedData)
+    return {
+        'mtf_value': levels.astype(np.float32),
+        'n_trials': n_trials.astype(np.int32),
+        'n_clear': n_clear.astype(np.int32),
+        'prop_clear': prop_clear.round(3).astype(np.float32),
+        'mean_rt': mean_rt.round(3).astype(np.float32)
+    }
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _build_mtf_psychometric_figure(grouped: GroupedData):
+    """Build the MTF psychometric figure (cached; each caller gets its own copy)"""
+    # Imported here: plotly is slow to import and only needed once results are shown
+    import plotly.graph_objects as go
     
     # Create plot
     fig = go.Figure()
     
     fig.add_trace(go.Scatter(
-        x=grouped['mtf_value'],
-        y=grouped['prop_clear'],
+        x=grouped.mtf_value,
+        y=grouped.prop_clear,
         mode='markers+lines',
         marker=dict(
-            size=grouped['n_trials'] * 3,
-            color=grouped['mean_rt'],
+            size=grouped.n_trials * 3,
+            color=grouped.mean_rt,
             colorscale='Viridis',
             showscale=True,
             colorbar=dict(title="Mean RT (s)")
@@ -1590,16 +1647,16 @@ def plot_mtf_psychometric_function(trial_data):
         'Proportion Clear: %{y:.2f}<br>' +
         'Trials: %{text}<br>' +
         'Mean RT: %{marker.color:.2f}s<extra></extra>',
-        text=grouped['n_trials']
+        text=grouped.n_trials
     ))
     
     # Add 50% threshold line
     fig.add_hline(y=0.5, line_dash="dash", line_color="red", annotation_text="50% Threshold")
     
     # Estimate threshold
-    if len(grouped) >= 2:
+    if len(grouped.mtf_value) >= 2:
         try:
-            threshold_estimate = np.interp(0.5, grouped['prop_clear'], grouped['mtf_value'])
+            threshold_estimate = np.interp(0.5, grouped.prop_clear, grouped.mtf_value)
             fig.add_vline(
                 x=threshold_estimate,
                 line_dash="dash",
@@ -1618,11 +1675,37 @@ def plot_mtf_psychometric_function(trial_data):
         height=500
     )
     
+    return fig
+
+def plot_mtf_psychometric_function(trial_data):
+    """Plot psychometric function for MTF data"""
+    if not trial_data:
+        st.warning("No trial data available for plotting")
+        return
+    
+    df = pd.DataFrame(trial_data)
+    
+    # Only pass the analysed columns so the cache key excludes the base64 stimulus images
+    grouped = GroupedData(**_group_mtf_trials(
+        df['mtf_value'].to_numpy(),
+        df['response'].to_numpy(),
+        df['reaction_time'].to_numpy()
+    ))
+    
+    # Filter groups with sufficient data
+    has_trials = grouped.n_trials >= 1
+    grouped = grouped._make(column[has_trials] for column in grouped)
+    
+    if len(grouped.mtf_value) == 0:
+        st.warning("Not enough data points for psychometric function")
+        return
+    
+    fig = _build_mtf_psychometric_figure(grouped)
     st.plotly_chart(fig, use_container_width=True)
     
-    # Show data table
+    # Show data table (the only consumer that needs a DataFrame)
     with st.expander("Detailed Results by MTF Value"):
-        st.dataframe(grouped, use_container_width=True)
+        st.dataframe(pd.DataFrame(grouped._asdict()), use_container_width=True)
 
 def ado_benchmark_screen():
     """ADO Performance Benchmark Testing Screen"""
@@ -1672,7 +1755,6 @@ def ado_benchmark_screen():
     if st.button("🚀 Run Benchmark", type="primary"):
         try:
             # Import ADO engine
-            from mtf_experiment import MTFExperimentManager
             from experiments.ado_utils import ADOEngine
             
             progress_bar = st.progress(0)
@@ -1760,7 +1842,7 @@ def ado_benchmark_screen():
                 with st.expander("詳細測試數據"):
                     results_df = pd.DataFrame({
                         'Trial': range(1, len(trial_times) + 1),
-                        'Time (ms)': [f"{t:.1f}" for t in trial_times]
+                        'Time (ms)': np.char.mod('%.1f', trial_times)
                     })
                     st.dataframe(results_df, use_container_width=True)
                     
@@ -3,12 +3,75 @@ CSV-based data manager for psychophysics experiments
 Replaces database storage with simple CSV file storage
 """
 import pandas as pd
+import numpy as np
 import os
 import csv
+import atexit
+import weakref
 from datetime import datetime
 from typing import List, Dict, Optional
 import json
 
+# orjson is optional; it is several times faster than json for the summary files
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# ASCII characters not allowed in file names derived from participant ids
+_UNSAFE_ASCII = str.maketrans('', '', ''.join(
+    chr(i) for i in range(128) if not (chr(i).isalnum() or chr(i) in '-_')
+))
+
+# Columns whose type pandas should not guess: ids such as "007" must stay text
+_READ_DTYPES = {
+    'participant_id': str,
+    'timestamp': str,
+    'experiment_timestamp': str,
+    'stimulus_image_file': str
+}
+
+# Live managers (one per Streamlit session); weak, so finished sessions can be collected
+_LIVE_MANAGERS = weakref.WeakSet()
+
+@atexit.register
+def _close_live_managers():
+    """Close CSV files still open when the server shuts down"""
+    for manager in list(_LIVE_MANAGERS):
+        manager.close()
+
+def _identity(value):
+    return value
+
+def _item(value):
+    return value.item()
+
+def _convert_by_dtype_kind(value):
+    kind = value.dtype.kind
+    if kind == 'f':
+        return float(value)
+    if kind in 'iu':
+        return int(value)
+    return str(value)
+
+# type(value) -> converter; plain Python types are already CSV/JSON friendly,
+# other types are resolved on first sight by _clean_value
+_CONVERTERS = {str: _identity, int: _identity, float: _identity, bool: _identity, type(None): _identity}
+
+def _clean_value(value):
+    """Convert a numpy value to the equivalent Python type (other values pass through)"""
+    converter = _CONVERTERS.get(type(value))
+    if converter is None:
+        if hasattr(value, 'item'):  # numpy scalar
+            converter = _item
+        elif hasattr(value, 'dtype'):  # numpy array/scalar
+            converter = _convert_by_dtype_kind
+        else:
+            converter = _identity
+        _CONVERTERS[type(value)] = converter
+    return converter(value)
+
 class CSVDataManager:
     """Manages experiment data using CSV files"""
     
@@ -19,7 +82,16 @@ class CSVDataManager:
             data_dir: Directory to store CSV files
         """
         self.data_dir = data_dir
+        # participant_id -> (summary file mtime_ns, raw JSON bytes); parsed per call so callers never share a dict
+        self._summary_cache: Dict[str, tuple] = {}
+        # participant_id -> (open CSV file, csv.writer, current fields), kept open between trials
+        self._open_files: Dict[str, tuple] = {}
+        # participant_id -> sanitized id used in file names
+        self._safe_ids: Dict[str, str] = {}
         self.ensure_data_directory()
+        
+        # Close the open CSV files when the server shuts down
+        _LIVE_MANAGERS.add(self)
     
     def ensure_data_directory(self):
         """Create data directory if it doesn't exist"""
@@ -27,15 +99,25 @@ class CSVDataManager:
             os.makedirs(self.data_dir)
             print(f"📁 Created data directory: {self.data_dir}")
     
+    def _safe_id(self, participant_id: str) -> str:
+        """Strip characters that are not alphanumeric, '-' or '_' from a participant id"""
+        safe_id = self._safe_ids.get(participant_id)
+        if safe_id is None:
+            if participant_id.isascii():
+                safe_id = participant_id.translate(_UNSAFE_ASCII)
+            else:
+                # Non-ASCII letters (e.g. Chinese names) count as alphanumeric too
+                safe_id = "".join(c for c in participant_id if c.isalnum() or c in ('-', '_'))
+            self._safe_ids[participant_id] = safe_id
+        return safe_id
+    
     def get_participant_file_path(self, participant_id: str) -> str:
         """Get file path for participant data"""
-        safe_id = "".join(c for c in participant_id if c.isalnum() or c in ('-', '_'))
-        return os.path.join(self.data_dir, f"{safe_id}_data.csv")
+        return os.path.join(self.data_dir, f"{self._safe_id(participant_id)}_data.csv")
     
     def get_experiment_summary_path(self, participant_id: str) -> str:
         """Get file path for experiment summary"""
-        safe_id = "".join(c for c in participant_id if c.isalnum() or c in ('-', '_'))
-        return os.path.join(self.data_dir, f"{safe_id}_summary.json")
+        return os.path.join(self.data_dir, f"{self._safe_id(participant_id)}_summary.json")
     
     def create_participant_record(self, participant_id: str, experiment_config: Dict):
         """Create initial participant record
@@ -55,11 +137,30 @@ class CSVDataManager:
             'completed_trials': 0
         }
         
-        with open(summary_path, 'w', encoding='utf-8') as f:
-            json.dump(summary_data, f, indent=2, ensure_ascii=False)
+        self._write_summary(participant_id, summary_path, summary_data)
         
         print(f"📋 Created participant record: {participant_id}")
     
+    def _write_summary(self, participant_id: str, summary_path: str, summary: Dict):
+        """Write summary JSON and keep the in-memory copy in sync"""
+        if ORJSON_AVAILABLE:
+            payload = orjson.dumps(
+                summary,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            )
+        else:
+            payload = json.dumps(summary, indent=2, ensure_ascii=False).encode('utf-8')
+        
+        # Write a temp file and swap it in, so a crash never leaves a half-written summary
+        tmp_path = summary_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, summary_path)
+        
+        self._summary_cache[participant_id] = (os.stat(summary_path).st_mtime_ns, payload)
+    
     def save_trial_data(self, participant_id: str, trial_data: Dict):
         """Save single trial data to CSV
         
@@ -67,32 +168,49 @@ class CSVDataManager:
             participant_id: Participant identifier
             trial_data: Trial data dictionary
         """
-        file_path = self.get_participant_file_path(participant_id)
-        
         # Add timestamp if not present
         if 'timestamp' not in trial_data:
             trial_data['timestamp'] = datetime.now().isoformat()
         
-        # Convert numpy types to Python types
-        cleaned_data = self._clean_trial_data(trial_data)
+        if not trial_data:
+            return
         
-        # Check if file exists to determine if we need headers
-        file_exists = os.path.exists(file_path)
+        # The file stays open for the session
+        csvfile, writer, fields = self._open_files.get(participant_id, (None, None, None))
+        if csvfile is None:
+            file_path = self.get_participant_file_path(participant_id)
+            csvfile = open(file_path, 'a', newline='', encoding='utf-8')
+            writer = csv.writer(csvfile)
+        
+        # Rows are written positionally; the field order is only rebuilt when the row keys change
+        if fields is None or trial_data.keys() != fields:
+            # Snapshot of the keys, so later changes to the caller's dict don't leak in
+            fields = dict.fromkeys(trial_data).keys()
+            
+            # Write header if file is new
+            if csvfile.tell() == 0:
+                writer.writerow(fields)
         
-        # Write to CSV
-        with open(file_path, 'a', newline='', encoding='utf-8') as csvfile:
-            if cleaned_data:
-                fieldnames = cleaned_data.keys()
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                
-                # Write header if file is new
-                if not file_exists:
-                    writer.writeheader()
-                
-                writer.writerow(cleaned_data)
+        # numpy values are converted on the way into the row
+        writer.writerow(self._clean_and_order(trial_data, fields))
+        
+        # Push the trial to the OS so it survives a crash and readers opening the file see it
+        csvfile.flush()
+        self._open_files[participant_id] = (csvfile, writer, fields)
         
         print(f"💾 Saved trial data for {participant_id}")
     
+    def _close_file(self, participant_id: str):
+        """Close the participant's CSV file if it is open"""
+        csvfile = self._open_files.pop(participant_id, (None,))[0]
+        if csvfile is not None:
+            csvfile.close()
+    
+    def close(self):
+        """Close all open CSV files"""
+        for participant_id in list(self._open_files):
+            self._close_file(participant_id)
+    
     def save_multiple_trials(self, participant_id: str, trials_data: List[Dict]):
         """Save multiple trials at once
         
@@ -105,12 +223,19 @@ class CSVDataManager:
         
         file_path = self.get_participant_file_path(participant_id)
         
+        # The file is overwritten, so release the append handle first
+        self._close_file(participant_id)
+        
         # Clean all trial data
         cleaned_trials = [self._clean_trial_data(trial) for trial in trials_data]
         
-        # Create DataFrame and save
-        df = pd.DataFrame(cleaned_trials)
-        df.to_csv(file_path, index=False, encoding='utf-8')
+        # Columns in first-seen order, like the DataFrame constructor; missing fields stay empty
+        fieldnames = list(dict.fromkeys(key for trial in cleaned_trials for key in trial))
+        
+        with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(cleaned_trials)
         
         print(f"💾 Saved {len(trials_data)} trials for {participant_id}")
     
@@ -123,24 +248,19 @@ class CSVDataManager:
         Returns:
             Cleaned trial data dictionary
         """
-        cleaned = {}
-        
-        for key, value in trial_data.items():
-            if value is None:
-                cleaned[key] = None
-            elif hasattr(value, 'item'):  # numpy scalar
-                cleaned[key] = value.item()
-            elif hasattr(value, 'dtype'):  # numpy array/scalar
-                if 'float' in str(value.dtype):
-                    cleaned[key] = float(value)
-                elif 'int' in str(value.dtype):
-                    cleaned[key] = int(value)
-                else:
-                    cleaned[key] = str(value)
-            else:
-                cleaned[key] = value
+        return {key: _clean_value(value) for key, value in trial_data.items()}
+    
+    def _clean_and_order(self, trial_data: Dict, fields) -> List:
+        """Clean trial data straight into a row of values in column order
         
-        return cleaned
+        Args:
+            trial_data: Raw trial data dictionary with exactly the keys in fields
+            fields: CSV column names, in column order
+            
+        Returns:
+            Cleaned values, positionally matching fields
+        """
+        return [_clean_value(trial_data[key]) for key in fields]
     
     def get_participant_data(self, participant_id: str) -> Optional[pd.DataFrame]:
         """Load participant data from CSV
@@ -157,7 +277,7 @@ class CSVDataManager:
             return None
         
         try:
-            df = pd.read_csv(file_path, encoding='utf-8')
+            df = pd.read_csv(file_path, encoding='utf-8', engine='c', dtype=_READ_DTYPES)
             return df
         except Exception as e:
             print(f"❌ Error loading data for {participant_id}: {e}")
@@ -174,16 +294,37 @@ class CSVDataManager:
         """
         summary_path = self.get_experiment_summary_path(participant_id)
         
-        if not os.path.exists(summary_path):
+        try:
+            mtime_ns = os.stat(summary_path).st_mtime_ns
+        except FileNotFoundError:
+            self._summary_cache.pop(participant_id, None)
             return None
         
+        return self._load_summary(participant_id, summary_path, mtime_ns)
+    
+    def _load_summary(self, participant_id: str, summary_path: str, mtime_ns: int) -> Optional[Dict]:
+        """Parse a summary file whose mtime is already known, reusing the cached copy"""
+        # Reuse the cached bytes unless the file was changed by someone else
+        cached = self._summary_cache.get(participant_id)
+        if cached is not None and cached[0] == mtime_ns:
+            return self._parse_summary(cached[1])
+        
         try:
-            with open(summary_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(summary_path, 'rb') as f:
+                payload = f.read()
+            summary = self._parse_summary(payload)
+            self._summary_cache[participant_id] = (mtime_ns, payload)
+            return summary
         except Exception as e:
             print(f"❌ Error loading summary for {participant_id}: {e}")
             return None
     
+    def _parse_summary(self, payload: bytes) -> Dict:
+        """Parse summary JSON bytes into a fresh dict"""
+        if ORJSON_AVAILABLE:
+            return orjson.loads(payload)
+        return json.loads(payload)
+    
     def update_experiment_status(self, participant_id: str, status: str, **kwargs):
         """Update experiment status and metadata
         
@@ -196,6 +337,10 @@ class CSVDataManager:
         if not summary:
             return
         
+        # Nothing to write if the status and fields already have these values
+        if summary.get('status') == status and all(summary.get(key) == value for key, value in kwargs.items()):
+            return
+        
         summary['status'] = status
         summary['updated_at'] = datetime.now().isoformat()
         
@@ -205,8 +350,7 @@ class CSVDataManager:
         
         # Save updated summary
         summary_path = self.get_experiment_summary_path(participant_id)
-        with open(summary_path, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, indent=2, ensure_ascii=False)
+        self._write_summary(participant_id, summary_path, summary)
     
     def complete_experiment(self, participant_id: str):
         """Mark experiment as completed
@@ -214,6 +358,9 @@ class CSVDataManager:
         Args:
             participant_id: Participant identifier
         """
+        # No more trials will follow, so release the append handle
+        self._close_file(participant_id)
+        
         # Get trial count
         df = self.get_participant_data(participant_id)
         trial_count = len(df) if df is not None else 0
@@ -236,11 +383,14 @@ class CSVDataManager:
         Returns:
             CSV data as string or None if not found
         """
-        df = self.get_participant_data(participant_id)
-        if df is None:
-            return None
+        # The file already is the CSV; return it as-is instead of parsing and re-encoding it
+        file_path = self.get_participant_file_path(participant_id)
         
-        return df.to_csv(index=False)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
     
     def list_participants(self) -> List[Dict]:
         """List all participants with their data files
@@ -253,28 +403,56 @@ class CSVDataManager:
         if not os.path.exists(self.data_dir):
             return participants
         
-        for filename in os.listdir(self.data_dir):
-            if filename.endswith('_data.csv'):
-                participant_id = filename[:-9]  # Remove '_data.csv'
-                
-                # Get file info
-                file_path = os.path.join(self.data_dir, filename)
-                file_stat = os.stat(file_path)
-                
-                # Try to get summary info
-                summary = self.get_experiment_summary(participant_id)
-                
-                participants.append({
-                    'participant_id': participant_id,
-                    'data_file': filename,
-                    'file_size': file_stat.st_size,
-                    'modified_at': datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
-                    'status': summary.get('status', 'unknown') if summary else 'unknown',
-                    'trial_count': len(pd.read_csv(file_path)) if os.path.exists(file_path) else 0
-                })
+        # One directory pass finds both the data files and their summaries
+        data_entries = {}
+        summary_entries = {}
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('_data.csv'):
+                    data_entries[entry.name[:-9]] = entry  # Remove '_data.csv'
+                elif entry.name.endswith('_summary.json'):
+                    summary_entries[entry.name[:-13]] = entry  # Remove '_summary.json'
+        
+        for participant_id, entry in data_entries.items():
+            filename = entry.name
+            
+            # Get file info
+            file_path = entry.path
+            file_stat = entry.stat()
+            
+            # Try to get summary info (cached unless the file changed)
+            summary_entry = summary_entries.get(participant_id)
+            summary = None
+            if summary_entry is not None:
+                summary = self._load_summary(participant_id, summary_entry.path, summary_entry.stat().st_mtime_ns)
+            
+            participants.append({
+                'participant_id': participant_id,
+                'data_file': filename,
+                'file_size': file_stat.st_size,
+                'modified_at': datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
+                'status': summary.get('status', 'unknown') if summary else 'unknown',
+                'trial_count': self._count_data_rows(file_path)
+            })
         
         return participants
     
+    def _count_data_rows(self, file_path: str) -> int:
+        """Count CSV data rows (excluding the header) without parsing the file"""
+        line_count = 0
+        last_chunk = b''
+        
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                line_count += chunk.count(b'\n')
+                last_chunk = chunk
+        
+        # A final row without a trailing newline still counts
+        if last_chunk and not last_chunk.endswith(b'\n'):
+            line_count += 1
+        
+        return max(line_count - 1, 0)
+    
     def calculate_psychometric_function(self, participant_id: str) -> Dict:
         """Calculate psychometric function from participant data
         
@@ -297,18 +475,63 @@ class CSVDataManager:
         
         # Group by stimulus difference
         if 'stimulus_difference' in df.columns:
-            grouped = df.groupby('stimulus_difference').agg({
-                'is_correct': ['count', 'sum', 'mean'],
-                'reaction_time': ['mean', 'std']
-            }).round(3)
-            
-            # Flatten column names
-            grouped.columns = ['_'.join(col).strip() for col in grouped.columns.values]
-            
-            return grouped.to_dict()
+            return self._aggregate_by_level(
+                df['stimulus_difference'].to_numpy(),
+                df['is_correct'],
+                df['reaction_time']
+            )
         
         return {}
     
+    def _aggregate_by_level(self, levels, is_correct: pd.Series, reaction_time: pd.Series) -> Dict:
+        """Per-level count/sum/mean of is_correct and mean/std of reaction_time
+        
+        Same output as the flattened groupby().agg(...).round(3).to_dict():
+        rows without a level are dropped and missing values are skipped.
+        """
+        codes, uniques = pd.factorize(levels, sort=True)
+        keep = codes >= 0
+        codes = codes[keep]
+        n_levels = len(uniques)
+        
+        correct = pd.to_numeric(is_correct, errors='coerce').to_numpy(dtype=np.float64)[keep]
+        rt = pd.to_numeric(reaction_time, errors='coerce').to_numpy(dtype=np.float64)[keep]
+        
+        has_correct = ~np.isnan(correct)
+        has_rt = ~np.isnan(rt)
+        correct = np.where(has_correct, correct, 0.0)
+        rt = np.where(has_rt, rt, 0.0)
+        
+        correct_count = np.bincount(codes, weights=has_correct, minlength=n_levels).astype(np.int64)
+        correct_sum = np.bincount(codes, weights=correct, minlength=n_levels)
+        rt_count = np.bincount(codes, weights=has_rt, minlength=n_levels)
+        rt_sum = np.bincount(codes, weights=rt, minlength=n_levels)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correct_mean = correct_sum / correct_count
+            rt_mean = rt_sum / rt_count
+            # Sample standard deviation (ddof=1), NaN for single-trial levels like pandas
+            rt_sq_dev = np.bincount(codes, weights=np.where(has_rt, rt - rt_mean[codes], 0.0) ** 2,
+                                    minlength=n_levels)
+            rt_std = np.sqrt(rt_sq_dev / (rt_count - 1))
+        rt_std[rt_count < 2] = np.nan
+        
+        # Integer/boolean responses sum to whole numbers, as in pandas
+        if is_correct.dtype.kind in 'biu':
+            correct_sum = correct_sum.astype(np.int64)
+        else:
+            correct_sum = correct_sum.round(3)
+        
+        keys = uniques.tolist()
+        columns = {
+            'is_correct_count': correct_count,
+            'is_correct_sum': correct_sum,
+            'is_correct_mean': correct_mean.round(3),
+            'reaction_time_mean': rt_mean.round(3),
+            'reaction_time_std': rt_std.round(3)
+        }
+        return {name: dict(zip(keys, values.tolist())) for name, values in columns.items()}
+    
     def cleanup_old_files(self, days_old: int = 30):
         """Remove old data files
         
@@ -318,14 +541,18 @@ class CSVDataManager:
         if not os.path.exists(self.data_dir):
             return
         
+        # Release open handles so files can be removed (reopened on the next trial)
+        self.close()
+        
         cutoff_time = datetime.now().timestamp() - (days_old * 24 * 3600)
         removed_count = 0
         
-        for filename in os.listdir(self.data_dir):
-            file_path = os.path.join(self.data_dir, filename)
-            if os.path.isfile(file_path) and os.path.getmtime(file_path) < cutoff_time:
-                os.remove(file_path)
-                removed_count += 1
+        # DirEntry answers is_file() from the directory listing and caches its stat()
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff_time:
+                    os.remove(entry.path)
+                    removed_count += 1
         
         if removed_count > 0:
             print(f"🗑️ Removed {removed_count} old data files")
\ No newline at end of file
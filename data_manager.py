@@ -1,10 +1,28 @@
 import pandas as pd
-import csv
 import json
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict
 import io
 
+# Column order for CSV exports (columns missing from the data are skipped)
+CSV_COLUMN_ORDER = (
+    'participant_id',
+    'trial_number',
+    'is_practice',
+    'left_stimulus',
+    'right_stimulus',
+    'stimulus_difference',
+    'response',
+    'correct_response',
+    'is_correct',
+    'reaction_time',
+    'timestamp',
+    'experiment_timestamp'
+)
+
+# Fields every trial must have to pass validate_trial_data
+REQUIRED_FIELDS = ('trial_number', 'response', 'reaction_time', 'participant_id')
+
 class DataManager:
     """Handles data storage, export, and analysis for the 2AFC experiment"""
     
@@ -29,24 +47,8 @@ class DataManager:
         # Create DataFrame from trial data
         df = pd.DataFrame(trial_data)
         
-        # Ensure consistent column order
-        desired_columns = [
-            'participant_id',
-            'trial_number',
-            'is_practice',
-            'left_stimulus',
-            'right_stimulus',
-            'stimulus_difference',
-            'response',
-            'correct_response',
-            'is_correct',
-            'reaction_time',
-            'timestamp',
-            'experiment_timestamp'
-        ]
-        
         # Reorder columns (only include those that exist)
-        existing_columns = [col for col in desired_columns if col in df.columns]
+        existing_columns = [col for col in CSV_COLUMN_ORDER if col in df.columns]
         df = df[existing_columns]
         
         # Convert to CSV string
@@ -223,11 +225,10 @@ class DataManager:
             return validation_results
         
         # Check for required fields
-        required_fields = ['trial_number', 'response', 'reaction_time', 'participant_id']
         missing_fields = set()
         
         for trial in trial_data:
-            for field in required_fields:
+            for field in REQUIRED_FIELDS:
                 if field not in trial:
                     missing_fields.add(field)
         
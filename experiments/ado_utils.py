@@ -12,8 +12,7 @@ Last reviewed: 2025-06
 
 import numpy as np
 import logging
-from typing import Tuple, Optional, Dict, Any, List
-from scipy.stats import entropy
+from typing import Tuple, Dict, Any
 
 # 設定日誌
 logger = logging.getLogger(__name__)
@@ -14,6 +14,14 @@ import cv2
 import numpy as np
 import time
 import os
+import logging
+
+# 確保使用 OpenCV 的最佳化（SIMD/IPP）路徑；並限制執行緒數，
+# 避免 Streamlit 多個 session 同時模糊圖片時過度配置 CPU
+cv2.setUseOptimized(True)
+cv2.setNumThreads(min(4, os.cpu_count() or 1))
+
+logger = logging.getLogger(__name__)
 
 def get_project_root():
     """獲取專案根目錄的絕對路徑。
@@ -129,29 +137,24 @@ def load_and_prepare_image(image_path, use_right_half=True):
     if img_bgr is None:
         raise FileNotFoundError(f"找不到圖片檔案：{image_path}")
     
-    # 轉換為 RGB 格式
-    if len(img_bgr.shape) == 3:
-        if img_bgr.shape[2] == 4:  # BGRA
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGRA2RGB)
-        else:  # BGR
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-    else:
+    if len(img_bgr.shape) != 3:
         raise ValueError("不支援的圖片格式")
     
     # 根據圖片類型和參數決定裁切方式
+    # 先裁切再轉色，色彩轉換只需處理保留的區域，並直接產生連續記憶體的結果
     if use_right_half:
         # 檢查是否為文字圖片
         image_name = os.path.basename(image_path).lower()
         
         if 'stimuli_img' in image_name:
             # 原始stimuli_img：取右半邊（保持原有行為）
-            width = img_rgb.shape[1]
+            width = img_bgr.shape[1]
             mid_point = width // 2
-            img_rgb = img_rgb[:, mid_point:]
-            print(f"stimuli_img裁切：從 {width} 取右半邊，結果寬度 {img_rgb.shape[1]}")
+            img_bgr = img_bgr[:, mid_point:]
+            logger.info(f"stimuli_img裁切：從 {width} 取右半邊，結果寬度 {img_bgr.shape[1]}")
         else:
             # 其他圖片（text_img, tw_newsimg, us_newsimg）：取中央部分
-            height, width = img_rgb.shape[:2]
+            height, width = img_bgr.shape[:2]
             target_width = width // 2  # 目標寬度為原圖的一半
             
             # 計算中央區域的起始和結束位置
@@ -163,8 +166,14 @@ def load_and_prepare_image(image_path, use_right_half=True):
             start_x = max(0, start_x)
             end_x = min(width, end_x)
             
-            img_rgb = img_rgb[:, start_x:end_x]
-            print(f"{image_name}裁切：從 {width}x{height} 裁切中央部分到 {img_rgb.shape[1]}x{img_rgb.shape[0]}")
+            img_bgr = img_bgr[:, start_x:end_x]
+            logger.info(f"{image_name}裁切：從 {width}x{height} 裁切中央部分到 {img_bgr.shape[1]}x{img_bgr.shape[0]}")
+    
+    # 轉換為 RGB 格式
+    if img_bgr.shape[2] == 4:  # BGRA
+        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGRA2RGB)
+    else:  # BGR
+        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
     
     return img_rgb
 
@@ -193,8 +202,8 @@ def benchmark_mtf_processing(image, mtf_values, iterations=10, **mtf_params):
     results = {}
     all_times = []
     
-    print(f"開始 MTF 處理效能測試 ({iterations} 次重複)...")
-    print("-" * 50)
+    logger.info(f"開始 MTF 處理效能測試 ({iterations} 次重複)...")
+    logger.info("-" * 50)
     
     for mtf in mtf_values:
         times = []
@@ -223,8 +232,8 @@ def benchmark_mtf_processing(image, mtf_values, iterations=10, **mtf_params):
         
         all_times.extend(times)
         
-        print(f"MTF {mtf:5.1f}%: {mean_time:6.2f} ± {std_time:5.2f} ms "
-              f"(範圍: {min_time:.2f} - {max_time:.2f})")
+        logger.info(f"MTF {mtf:5.1f}%: {mean_time:6.2f} ± {std_time:5.2f} ms "
+                    f"(範圍: {min_time:.2f} - {max_time:.2f})")
     
     # 整體統計
     overall_mean = np.mean(all_times)
@@ -239,9 +248,9 @@ def benchmark_mtf_processing(image, mtf_values, iterations=10, **mtf_params):
         'max': overall_max
     }
     
-    print("-" * 50)
-    print(f"整體統計：{overall_mean:.2f} ± {overall_std:.2f} ms")
-    print(f"範圍：{overall_min:.2f} - {overall_max:.2f} ms")
+    logger.info("-" * 50)
+    logger.info(f"整體統計：{overall_mean:.2f} ± {overall_std:.2f} ms")
+    logger.info(f"範圍：{overall_min:.2f} - {overall_max:.2f} ms")
     
     return results
 
@@ -249,6 +258,9 @@ def benchmark_mtf_processing(image, mtf_values, iterations=10, **mtf_params):
 if __name__ == "__main__":
     """測試用的主程式"""
     
+    # 顯示模組的 logger 輸出（格式與原本的 print 相同）
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     # 獲取專案根目錄
     project_root = get_project_root()
     
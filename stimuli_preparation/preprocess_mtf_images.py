@@ -5,7 +5,6 @@ from datetime import datetime
 import time
 import platform
 import psutil
-import statistics
 
 def get_project_root():
     """獲取專案根目錄的絕對路徑。
@@ -123,13 +122,14 @@ def benchmark_processing(image_path, mtf_values, frequency_lpmm, pixel_size_mm,
     # 計算統計數據
     stats = {}
     for mtf in mtf_values:
-        times = all_times[mtf]
+        # 轉成陣列一次，之後的統計都在 NumPy 中完成（中位數用 partition，不需排序）
+        times = np.asarray(all_times[mtf], dtype=np.float64)
         stats[mtf] = {
-            "平均": statistics.mean(times),
-            "中位數": statistics.median(times),
-            "標準差": statistics.stdev(times) if len(times) > 1 else 0,
-            "最小值": min(times),
-            "最大值": max(times)
+            "平均": float(times.mean()),
+            "中位數": float(np.median(times)),
+            "標準差": float(times.std(ddof=1)) if times.size > 1 else 0,
+            "最小值": float(times.min()),
+            "最大值": float(times.max())
         }
     
     return stats
@@ -167,12 +167,12 @@ def main():
             print(f"{mtf:6d} {s['平均']:12.2f} {s['中位數']:12.2f} {s['標準差']:12.2f} {s['最小值']:12.2f} {s['最大值']:12.2f}")
         
         # 計算整體統計
-        all_means = [s['平均'] for s in stats.values()]
+        all_means = np.array([s['平均'] for s in stats.values()])
         print("\n整體統計：")
-        print(f"所有 MTF 值的平均處理時間：{statistics.mean(all_means):.2f} ms")
-        print(f"所有 MTF 值的處理時間標準差：{statistics.stdev(all_means):.2f} ms")
-        print(f"最快處理時間：{min(all_means):.2f} ms")
-        print(f"最慢處理時間：{max(all_means):.2f} ms")
+        print(f"所有 MTF 值的平均處理時間：{all_means.mean():.2f} ms")
+        print(f"所有 MTF 值的處理時間標準差：{all_means.std(ddof=1):.2f} ms")
+        print(f"最快處理時間：{all_means.min():.2f} ms")
+        print(f"最慢處理時間：{all_means.max():.2f} ms")
         
         # 生成所有 MTF 圖片
         print("\n開始生成 MTF 圖片...")